@@ -1,8 +1,6 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import mean_squared_error
 import plotly.graph_objects as go
 from io import StringIO, BytesIO
 
@@ -14,33 +12,52 @@ st.set_page_config(
     initial_sidebar_state="auto"
 )
 
+# --- Constants ---
+
+REQUIRED_COLUMNS = ['Data', 'Tmin', 'Tmax', 'NF']
+
 # --- Functions ---
 
+@st.cache_data(show_spinner=False)
+def read_file(file_bytes, file_name):
+    """Parses CSV or Excel file contents into a dataframe, cached on the file bytes and name."""
+    if file_name.endswith('.csv'):
+        # Attempt the multithreaded pyarrow parser first
+        try:
+            return pd.read_csv(BytesIO(file_bytes), engine='pyarrow')
+        except Exception:
+            pass
+        # Then read with standard separator, then with comma as decimal
+        try:
+            return pd.read_csv(BytesIO(file_bytes))
+        except Exception:
+            return pd.read_csv(BytesIO(file_bytes), decimal=',')
+    elif file_name.endswith(('.xls', '.xlsx')):
+        # Keep only the required columns (the whole sheet is still read); missing ones are reported by validate_data
+        usecols = lambda col: col in REQUIRED_COLUMNS
+        # calamine parses the workbook much faster; fall back to openpyxl if it is not installed
+        try:
+            return pd.read_excel(BytesIO(file_bytes), engine='calamine', usecols=usecols)
+        except ImportError:
+            return pd.read_excel(BytesIO(file_bytes), engine='openpyxl', usecols=usecols)
+    return None
+
 def load_data(uploaded_file):
     """Loads data from CSV or Excel, handling potential parsing errors."""
     try:
-        if uploaded_file.name.endswith('.csv'):
-            # Attempt to read with standard separator, then with comma as decimal
-            try:
-                return pd.read_csv(uploaded_file)
-            except Exception:
-                uploaded_file.seek(0)
-                return pd.read_csv(uploaded_file, decimal=',')
-        elif uploaded_file.name.endswith(('.xls', '.xlsx')):
-            return pd.read_excel(uploaded_file, engine='openpyxl')
+        return read_file(uploaded_file.getvalue(), uploaded_file.name)
     except Exception as e:
         st.error(f"Erro ao carregar o arquivo: {e}")
         st.info("Por favor, verifique se o arquivo é um CSV ou Excel válido e se as colunas estão nos formatos corretos.")
         return None
-    return None
 
+@st.cache_data(show_spinner=False)
 def validate_data(df):
     """Validates the dataframe columns and data."""
-    required_cols = ['Data', 'Tmin', 'Tmax', 'NF']
     errors = []
     
     # Check for required columns
-    missing_cols = [col for col in required_cols if col not in df.columns]
+    missing_cols = [col for col in REQUIRED_COLUMNS if col not in df.columns]
     if missing_cols:
         errors.append(f"Colunas obrigatórias não encontradas no arquivo: {', '.join(missing_cols)}. Por favor, renomeie as colunas para 'Data', 'Tmin', 'Tmax', 'NF'.")
         return df, errors
@@ -59,56 +76,79 @@ def validate_data(df):
     for col in ['Tmin', 'Tmax', 'NF']:
         df[col] = pd.to_numeric(df[col], errors='coerce')
 
-    # Check for Tmin > Tmax
-    if (df['Tmin'] > df['Tmax']).any():
+    # Check for Tmin > Tmax (comparisons with NaN are False)
+    if np.any(df['Tmin'].to_numpy() > df['Tmax'].to_numpy()):
         errors.append("Existem linhas onde a 'Tmin' é maior que a 'Tmax'. Por favor, verifique os dados de temperatura.")
 
     # Check for decrease in NF
-    nf_series = df['NF'].dropna().reset_index(drop=True)
-    if (nf_series.diff() < 0).any():
-       errors.append("Existem linhas onde o 'NF' (Número de Folhas) diminui em relação à medição anterior. Isso pode indicar um erro de digitação.")
+    nf = df['NF'].dropna().to_numpy()
+    if np.any(np.diff(nf) < 0):
+        errors.append("Existem linhas onde o 'NF' (Número de Folhas) diminui em relação à medição anterior. Isso pode indicar um erro de digitação.")
 
     return df, errors
 
 
+def sweep_tb(tmed, pheno_idx, nf, base_temps):
+    """Returns the QME and R2 of the NF ~ STa regression for each base temperature."""
+    y = nf
+    
+    # A Tb at or above the warmest daily mean never accumulates thermal sum,
+    # so its regression is the flat fit: QME is the variance of NF and R2 is 0
+    active = base_temps < np.nanmax(tmed)
+    mse = np.full(len(base_temps), y.var())
+    r2 = np.zeros(len(base_temps))
+    tbs = base_temps[active]
+    
+    # Daily thermal sum (STd) for every remaining Tb at once: one column per Tb
+    sta_all = np.subtract.outer(tmed, tbs)
+    # fmax treats a day with a missing temperature as zero STd, like the pandas cumsum skipping NaN
+    np.fmax(sta_all, 0.0, out=sta_all)
+    
+    # Accumulated thermal sum (STa), in the same buffer, gathered on the dates with NF measurements
+    np.cumsum(sta_all, axis=0, out=sta_all)
+    X = sta_all[pheno_idx, :]
+    
+    # Closed-form simple linear regression for every Tb column
+    n = len(y)
+    sx = X.sum(axis=0)
+    sy = y.sum()
+    sxx = (X * X).sum(axis=0)
+    sxy = (X * y[:, None]).sum(axis=0)
+    var_x = sxx - sx * sx / n
+    cov_xy = sxy - sx * sy / n
+    slope = np.divide(cov_xy, var_x, out=np.zeros_like(cov_xy), where=var_x > 0)
+    intercept = (sy - slope * sx) / n
+    
+    # Calculate metrics
+    mse[active] = ((y[:, None] - slope * X - intercept) ** 2).mean(axis=0)
+    r2[active] = 1 - mse[active] / y.var()
+
+    return mse, r2
+
+
+@st.cache_data(show_spinner=False)
 def calculate_tb(df):
     """Calculates the basal temperature by minimizing the MSE."""
-    df['Tmed'] = (df['Tmin'] + df['Tmax']) / 2
+    tmed = ((df['Tmin'] + df['Tmax']) / 2).to_numpy()
+    if np.all(np.isnan(tmed)):
+        raise ValueError("Nenhum dia possui valores válidos de 'Tmin' e 'Tmax'.")
     
-    pheno_df = df.dropna(subset=['NF']).copy()
+    # Positions of the dates with NF measurements
+    nf = df['NF'].to_numpy()
+    pheno_idx = np.flatnonzero(df['NF'].notna().to_numpy())
     
-    results = []
     # Define the range of base temperatures to test
     base_temps = np.arange(0, 20.5, 0.5)
 
-    for tb in base_temps:
-        # Calculate daily thermal sum (STd)
-        df['STd'] = df['Tmed'] - tb
-        df.loc[df['STd'] < 0, 'STd'] = 0
-        
-        # Calculate accumulated thermal sum (STa)
-        df['STa'] = df['STd'].cumsum()
-        
-        # Get the STa for the dates with NF measurements
-        sta_for_regression = df.loc[pheno_df.index]['STa']
-        
-        # Prepare data for regression
-        X = sta_for_regression.values.reshape(-1, 1)
-        y = pheno_df['NF'].values
-        
-        # Perform linear regression
-        model = LinearRegression()
-        model.fit(X, y)
-        y_pred = model.predict(X)
-        
-        # Calculate metrics
-        mse = mean_squared_error(y, y_pred)
-        r2 = model.score(X, y)
-        
-        results.append({'Tb': tb, 'QME': mse, 'R2': r2})
-
-    results_df = pd.DataFrame(results)
-    best_tb = results_df.loc[results_df['QME'].idxmin()]
+    mse, r2 = sweep_tb(tmed, pheno_idx, nf[pheno_idx], base_temps)
+
+    if np.all(np.isnan(mse)):
+        raise ValueError("Não foi possível calcular o QME para nenhuma Tb. Verifique se há medições de 'NF' suficientes.")
+    best_i = int(np.nanargmin(mse))
+    best_tb = {'Tb': base_temps[best_i], 'QME': mse[best_i], 'R2': r2[best_i]}
+    
+    # The full table is only needed for display
+    results_df = pd.DataFrame({'Tb': base_temps, 'QME': mse, 'R2': r2})
     
     return results_df, best_tb
 
@@ -150,54 +190,67 @@ if uploaded_file is not None:
         else:
             st.info("Os dados foram validados e parecem corretos. Iniciando a análise...")
 
-            with st.spinner("Calculando a Temperatura Basal... Este processo pode levar um momento."):
-                results_df, best_tb = calculate_tb(validated_data.copy())
+            try:
+                with st.spinner("Calculando a Temperatura Basal... Este processo pode levar um momento."):
+                    results_df, best_tb = calculate_tb(validated_data)
+            except ValueError as e:
+                st.error(f"Erro ao calcular a Temperatura Basal: {e}")
+                results_df = None
 
-            st.header("Resultados da Análise")
+            if results_df is not None:
+                st.header("Resultados da Análise")
             
-            # Display the best Tb
-            col1, col2 = st.columns(2)
-            col1.metric(
-                label="Temperatura Basal Estimada (Tb)",
-                value=f"{best_tb['Tb']:.1f} °C"
-            )
-            col2.metric(
-                label="Menor Quadrado Médio do Erro (QME)",
-                value=f"{best_tb['QME']:.4f}"
-            )
-
-            # Display Plotly chart
-            fig = go.Figure()
-            fig.add_trace(go.Scatter(
-                x=results_df['Tb'], 
-                y=results_df['QME'],
-                mode='lines+markers',
-                name='QME',
-                marker=dict(color='#1f77b4') # Professional blue
-            ))
-            # Add a vertical line for the best Tb
-            fig.add_vline(
-                x=best_tb['Tb'], 
-                line_width=2, 
-                line_dash="dash", 
-                line_color="#d62728" # Professional red
-            )
-            fig.update_layout(
-                title="Quadrado Médio do Erro (QME) vs. Temperatura Basal (Tb)",
-                xaxis_title="Temperatura Basal (°C)",
-                yaxis_title="Quadrado Médio do Erro (QME)",
-                template="plotly_white",
-                font=dict(family="sans-serif")
-            )
-            st.plotly_chart(fig, use_container_width=True)
-
-            # Display results table in an expander
-            with st.expander("Ver Tabela de Resultados Detalhados"):
-                st.dataframe(results_df.style.format({
-                    'Tb': '{:.1f}',
-                    'QME': '{:.4f}',
-                    'R2': '{:.4f}'
-                }))
+                # Display the best Tb
+                col1, col2 = st.columns(2)
+                col1.metric(
+                    label="Temperatura Basal Estimada (Tb)",
+                    value=f"{best_tb['Tb']:.1f} °C"
+                )
+                col2.metric(
+                    label="Menor Quadrado Médio do Erro (QME)",
+                    value=f"{best_tb['QME']:.4f}"
+                )
+
+                # Display Plotly chart, built in a single constructor call
+                traces = [
+                    go.Scatter(
+                        x=results_df['Tb'], 
+                        y=results_df['QME'],
+                        mode='lines+markers',
+                        name='QME',
+                        marker=dict(color='#1f77b4') # Professional blue
+                    )
+                ]
+                # Vertical line for the best Tb, spanning the full plot height
+                best_tb_line = dict(
+                    type='line',
+                    x0=best_tb['Tb'],
+                    x1=best_tb['Tb'],
+                    y0=0,
+                    y1=1,
+                    yref='paper',
+                    line=dict(width=2, dash='dash', color='#d62728') # Professional red
+                )
+                fig = go.Figure(
+                    data=traces,
+                    layout=go.Layout(
+                        title="Quadrado Médio do Erro (QME) vs. Temperatura Basal (Tb)",
+                        xaxis_title="Temperatura Basal (°C)",
+                        yaxis_title="Quadrado Médio do Erro (QME)",
+                        template="plotly_white",
+                        font=dict(family="sans-serif"),
+                        shapes=[best_tb_line]
+                    )
+                )
+                st.plotly_chart(fig, use_container_width=True)
+
+                # Display results table in an expander
+                with st.expander("Ver Tabela de Resultados Detalhados"):
+                    st.dataframe(results_df.style.format({
+                        'Tb': '{:.1f}',
+                        'QME': '{:.4f}',
+                        'R2': '{:.4f}'
+                    }))
 
 else:
     st.info("Aguardando o upload de um arquivo de dados para iniciar a análise.")